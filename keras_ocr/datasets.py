@@ -325,7 +325,7 @@ def get_detector_image_generator(labels,
                                          min_area=min_area,
                                          augmenter=augmenter)
         if focused:
-            boxes = [tools.combine_line(line)[0] for line in lines]
+            boxes = [box for box, _ in tools.combine_lines(lines)]
             if boxes:
                 selected = np.array(boxes[np.random.choice(len(boxes))])
                 left, top = selected.min(axis=0).clip(0, np.inf).astype('int')
@@ -423,12 +423,11 @@ class Recognizer:
             if self.prediction_model.input_shape[-1] == 1 and image.shape[-1] == 3:
                 # Convert color to grayscale
                 image = cv2.cvtColor(image, code=cv2.COLOR_RGB2GRAY)
-            for box in boxes:
-                crops.append(
-                    tools.warpBox(image=image,
-                                  box=box,
-                                  target_height=self.model.input_shape[1],
-                                  target_width=self.model.input_shape[2]))
+            crops.extend(
+                tools.warpBox_batch(image=image,
+                                    boxes=boxes,
+                                    target_height=self.model.input_shape[1],
+                                    target_width=self.model.input_shape[2]))
             start = 0 if not start_end else start_end[-1][1]
             start_end.append((start, start + len(boxes)))
         if not crops:
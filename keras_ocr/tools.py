@@ -1,8 +1,14 @@
 # pylint: disable=invalid-name,too-many-branches,too-many-statements,too-many-arguments
+# pylint: disable=import-outside-toplevel
 import os
 import io
+import math
 import typing
 import hashlib
+import functools
+import itertools
+import collections
+import concurrent.futures
 import urllib.request
 import urllib.parse
 
@@ -11,17 +17,11 @@ import imgaug
 import numpy as np
 import pandas as pd
 import validators
-import matplotlib.pyplot as plt
-from shapely import geometry
-from scipy import spatial
-
-import tqdm.notebook
 from xml.etree import ElementTree
 from PIL import Image
 
 import tensorflow as tf
 from tensorflow import keras
-from tensorflow_addons import image as image_tfa
 
 
 
@@ -30,12 +30,32 @@ from tensorflow.python.framework import ops
 
 from tensorflow.python.ops import array_ops
 from tensorflow.keras import layers
-from tensorflow_addons.utils.resource_loader import LazySO
-from tensorflow_addons.image import connected_components
-_image_so = LazySO("custom_ops/image/_image_ops.so")
 
 from . import recognition, detection
 
+try:
+    import turbojpeg
+    _turbojpeg = turbojpeg.TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    _turbojpeg = None
+
+_JPEG_MAGIC = b'\xff\xd8'
+_EXIF_ORIENTATION = 0x0112
+
+try:
+    from numba import njit
+except ImportError:
+
+    def njit(*args, **kwargs):  # type: ignore[no-redef] # pylint: disable=unused-argument
+        """Stand-in for numba.njit that leaves the function as plain Python."""
+        return lambda func: func
+
+
+def _has_exif_rotation(data):
+    # only the header is parsed, the image itself is not decoded
+    with Image.open(io.BytesIO(data)) as image:
+        return image.getexif().get(_EXIF_ORIENTATION, 1) != 1
+
 
 def read(filepath_or_buffer: typing.Union[str, io.BytesIO]):
     """Read a file into an image object
@@ -43,18 +63,35 @@ def read(filepath_or_buffer: typing.Union[str, io.BytesIO]):
     Args:
         filepath_or_buffer: The path to the file, a URL, or any object
             with a `read` method (such as `io.BytesIO`)
+
+    If PyTurboJPEG is installed, JPEG files are decoded directly to RGB
+    using libjpeg-turbo; files with an EXIF orientation tag still go
+    through OpenCV so that the orientation is applied as before. Other
+    buffers are decoded to RGB by Pillow, which benefits from a
+    pillow-simd build if one is installed.
     """
     if isinstance(filepath_or_buffer, np.ndarray):
         return filepath_or_buffer
     if hasattr(filepath_or_buffer, 'read'):
-        image = np.asarray(bytearray(filepath_or_buffer.read()), dtype=np.uint8)
-        image = cv2.imdecode(image, cv2.IMREAD_UNCHANGED)
+        data = filepath_or_buffer.read()
+        if _turbojpeg is not None and data[:2] == _JPEG_MAGIC:
+            return _turbojpeg.decode(data, pixel_format=turbojpeg.TJPF_RGB)
+        pil_image = Image.open(io.BytesIO(data))
+        pil_image.draft('RGB', pil_image.size)
+        return np.array(pil_image.convert('RGB'))
     elif isinstance(filepath_or_buffer, str):
         if validators.url(filepath_or_buffer):
             return read(urllib.request.urlopen(filepath_or_buffer))
         assert os.path.isfile(filepath_or_buffer), \
             'Could not find image at path: ' + filepath_or_buffer
-        image = cv2.imread(filepath_or_buffer)
+        if _turbojpeg is not None:
+            with open(filepath_or_buffer, 'rb') as f:
+                data = f.read()
+            if data[:2] == _JPEG_MAGIC and not _has_exif_rotation(data):
+                return _turbojpeg.decode(data, pixel_format=turbojpeg.TJPF_RGB)
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        else:
+            image = cv2.imread(filepath_or_buffer)
     return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 
 
@@ -66,14 +103,66 @@ def get_rotated_width_height(box):
         box: A list of four points starting in the top left
         corner and moving clockwise.
     """
-    w = (spatial.distance.cdist(box[0][np.newaxis], box[1][np.newaxis], "euclidean") +
-         spatial.distance.cdist(box[2][np.newaxis], box[3][np.newaxis], "euclidean")) / 2
-    h = (spatial.distance.cdist(box[0][np.newaxis], box[3][np.newaxis], "euclidean") +
-         spatial.distance.cdist(box[1][np.newaxis], box[2][np.newaxis], "euclidean")) / 2
-    return int(w[0][0]), int(h[0][0])
+    w = (math.hypot(box[0][0] - box[1][0], box[0][1] - box[1][1]) +
+         math.hypot(box[2][0] - box[3][0], box[2][1] - box[3][1])) / 2
+    h = (math.hypot(box[0][0] - box[3][0], box[0][1] - box[3][1]) +
+         math.hypot(box[1][0] - box[2][0], box[1][1] - box[2][1])) / 2
+    return int(w), int(h)
+
+
+def get_border_value(cval, image):
+    """Convert a fill value into the per-channel scalar expected by OpenCV
+    border arguments.
+
+    Args:
+        cval: A single value or one value per channel
+        image: The image to which the border will be applied
+    """
+    return tuple(int(v) for v in np.broadcast_to(cval, image.shape[2:] or (1, )))
 
 
 # pylint:disable=too-many-locals
+def warpBox_batch(image, boxes, target_height, target_width, margin=0, cval=None):
+    """Warp a set of boxed regions in an image, each given by a set of four
+    points, into rectangles with a specified width and height. Each box is
+    scaled to fit its rectangle (preserving aspect ratio) using a single
+    affine warp and placed in the top left corner; the remainder is filled
+    with `cval`.
+
+    Args:
+        image: The image from which to take the boxes
+        boxes: An array of shape (N, 4, 2) where each box is a list of four
+            points starting in the top left corner and moving clockwise.
+        target_height: The height of the output rectangles
+        target_width: The width of the output rectangles
+        margin: The margin to apply around each box.
+        cval: The value to use for filling the remaining areas.
+
+    Returns:
+        An array of shape (N, target_height, target_width[, channels])
+    """
+    if cval is None:
+        cval = (0, 0, 0) if len(image.shape) == 3 else 0
+    border_value = get_border_value(cval, image)
+    warped = np.empty((len(boxes), target_height, target_width) + image.shape[2:], dtype='uint8')
+    for index, box in enumerate(boxes):
+        w, h = get_rotated_width_height(box)
+        scale = min(target_width / w, target_height / h)
+        M = cv2.getAffineTransform(src=np.float32([box[0], box[1], box[3]]),
+                                   dst=np.float32([[margin, margin], [scale * w - margin, margin],
+                                                   [margin, scale * h - margin]]))
+        cv2.warpAffine(image,
+                       M,
+                       dsize=(target_width, target_height),
+                       dst=warped[index],
+                       flags=cv2.INTER_LINEAR,
+                       borderMode=cv2.BORDER_CONSTANT,
+                       borderValue=border_value)
+        warped[index, int(scale * h):] = cval
+        warped[index, :, int(scale * w):] = cval
+    return warped
+
+
 def warpBox(image,
             box,
             target_height=None,
@@ -91,27 +180,19 @@ def warpBox(image,
             corner and moving clockwise.
         target_height: The height of the output rectangle
         target_width: The width of the output rectangle
-        return_transform: Whether to return the transformation
-            matrix with the image.
-    """  
-
-    if cval is None:
-        cval = (0, 0, 0) if len(image.shape) == 3 else 0
-        
-    w, h =  abs(box[2][0] - box[0][0]), abs(box[2][1] - box[0][1])
-    scale = min(target_width / w, target_height / h)
-    crop = image[min(int(box[0][1]),int(box[2][1])):max(int(box[0][1]),int(box[2][1])),
-                 min(int(box[0][0]), int(box[2][0]) ) : max(int(box[0][0]), int(box[2][0]) )]
-    crop = cv2.resize(crop, (int(w*scale), int(h*scale)))
-    target_shape = (target_height, target_width, 3) if len(image.shape) == 3 else (target_height,
-                                                                                   target_width)    
-    full = (np.zeros(target_shape) + cval).astype('uint8')
-    full[:crop.shape[0], :crop.shape[1]] = crop
-    return full
+        margin: The margin to apply around the box.
+        cval: The value to use for filling the remaining area.
+    """
+    return warpBox_batch(image=image,
+                         boxes=[box],
+                         target_height=target_height,
+                         target_width=target_width,
+                         margin=margin,
+                         cval=cval)[0]
 
 
 def flatten(list_of_lists):
-    return [item for sublist in list_of_lists for item in sublist]
+    return list(itertools.chain.from_iterable(list_of_lists))
 
 
 def combine_line(line):
@@ -124,17 +205,44 @@ def combine_line(line):
     Returns:
         A (box, text) tuple
     """
-    text = ''.join([character if character is not None else '' for _, character in line])
-    box = np.concatenate([coords[:2] for coords, _ in line] +
-                         [np.array([coords[3], coords[2]])
-                          for coords, _ in reversed(line)]).astype('float32')
-    first_point = box[0]
-    rectangle = cv2.minAreaRect(box)
-    box = cv2.boxPoints(rectangle)
+    return combine_lines([line])[0]
+
 
-    # Put the points in clockwise order
-    box = np.array(np.roll(box, -np.linalg.norm(box - first_point, axis=1).argmin(), 0))
-    return box, text
+def combine_lines(lines):
+    """Combine the boxes in each of a set of lines into a single
+    bounding box per line. The points for all lines are gathered
+    into one buffer up front.
+
+    Args:
+        lines: A list of lines, each a list of (box, character) entries
+
+    Returns:
+        A list of (box, text) tuples, one for each line
+    """
+    coords = np.asarray([coords for line in lines for coords, _ in line],
+                        dtype='float32').reshape(-1, 4, 2)
+    points = np.empty((4 * len(coords), 2), dtype='float32')
+    combined = []
+    start = 0
+    for line in lines:
+        n = len(line)
+        line_coords = coords[start:start + n]
+        box = points[4 * start:4 * (start + n)]
+        start += n
+        # The top edges from left to right followed by the bottom
+        # edges from right to left.
+        box[:2 * n] = line_coords[:, :2].reshape(-1, 2)
+        box[2 * n:] = line_coords[::-1, [3, 2]].reshape(-1, 2)
+        first_point = box[0]
+        rectangle = cv2.minAreaRect(box)
+        box = cv2.boxPoints(rectangle)
+
+        # Put the points in clockwise order
+        index = int(((box - first_point)**2).sum(axis=1).argmin())
+        box = box[(np.arange(4) + index) % 4]
+        text = ''.join([character if character is not None else '' for _, character in line])
+        combined.append((box, text))
+    return combined
 
 
 def drawAnnotations(image, predictions, ax=None):
@@ -145,6 +253,7 @@ def drawAnnotations(image, predictions, ax=None):
         predictions: The predictions as provided by `pipeline.recognize`.
         ax: A matplotlib axis on which to draw.
     """
+    import matplotlib.pyplot as plt
     if ax is None:
         _, ax = plt.subplots()
     ax.imshow(drawBoxes(image=image, boxes=predictions, boxes_format='predictions'))
@@ -177,7 +286,7 @@ def drawAnnotations(image, predictions, ax=None):
     return ax
 
 
-def drawBoxes(image, boxes, color=(255, 0, 0), thickness=5, boxes_format='boxes'):
+def drawBoxes(image, boxes, color=(255, 0, 0), thickness=5, boxes_format='boxes', inplace=False):
     """Draw boxes onto an image.
 
     Args:
@@ -194,10 +303,11 @@ def drawBoxes(image, boxes, color=(255, 0, 0), thickness=5, boxes_format='boxes'
             or "predictions" where boxes is by itself a list of (word, box) tuples
             as provided by `keras_ocr.pipeline.Pipeline.recognize` or
             `keras_ocr.recognition.Recognizer.recognize_from_boxes`.
+        inplace: Whether to draw directly on `image` instead of on a copy.
     """
     if len(boxes) == 0:
         return image
-    canvas = image.copy()
+    canvas = image if inplace else image.copy()
     if boxes_format == 'lines':
         revised_boxes = []
         for line in boxes:
@@ -209,12 +319,11 @@ def drawBoxes(image, boxes, color=(255, 0, 0), thickness=5, boxes_format='boxes'
         for _, box in boxes:
             revised_boxes.append(box)
         boxes = revised_boxes
-    for box in boxes:
-        cv2.polylines(img=canvas,
-                      pts=box[np.newaxis].astype('int32'),
-                      color=color,
-                      thickness=thickness,
-                      isClosed=True)
+    cv2.polylines(img=canvas,
+                  pts=np.asarray(boxes).astype('int32'),
+                  color=color,
+                  thickness=thickness,
+                  isClosed=True)
     return canvas
 
 
@@ -238,6 +347,19 @@ def adjust_boxes(boxes, boxes_format='boxes', scale=1):
     raise NotImplementedError(f'Unsupported boxes format: {boxes_format}')
 
 
+def get_polygon_areas(boxes):
+    """Compute the areas of a set of quadrilaterals using the shoelace
+    formula. Coordinates are truncated to integers first, matching
+    `cv2.contourArea` on int32 contours.
+
+    Args:
+        boxes: An array of shape (N, 4, 2)
+    """
+    xy = np.asarray(boxes).astype('int32').astype('float64')
+    x, y = xy[..., 0], xy[..., 1]
+    return 0.5 * np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1))
+
+
 def augment(boxes,
             augmenter: imgaug.augmenters.meta.Augmenter,
             image=None,
@@ -256,10 +378,23 @@ def augment(boxes,
         area_threshold: Fraction of bounding box that we require to be
             in augmented image to include it.
         min_area: The minimum area for a character to be included.
+
+    An augmenter that is already deterministic (see
+    `imgaug.augmenters.meta.Augmenter.to_deterministic`) is used as is.
     """
     if image is None and image_shape is None:
         raise ValueError('One of "image" or "image_shape" must be provided.')
-    augmenter = augmenter.to_deterministic()
+    if boxes_format == 'boxes':
+        points = boxes
+    elif boxes_format == 'lines':
+        points = [box for line in boxes for box, _ in line]
+    elif boxes_format == 'predictions':
+        points = [box for _, box in boxes]
+    else:
+        raise NotImplementedError(f'Unsupported boxes format: {boxes_format}')
+    points = np.asarray(points, dtype='float32').reshape(-1, 2)
+    if not augmenter.deterministic:
+        augmenter = augmenter.to_deterministic()
 
     if image is not None:
         image_augmented = augmenter(image=image)
@@ -267,47 +402,48 @@ def augment(boxes,
         image_augmented_shape = image_augmented.shape[:2]
     else:
         image_augmented = None
-        width_augmented, height_augmented = augmenter.augment_keypoints(
-            imgaug.KeypointsOnImage.from_xy_array(xy=[[image_shape[1], image_shape[0]]],
-                                                  shape=image_shape)).to_xy_array()[0]
+        # Obtain the augmented image shape by augmenting the bottom right
+        # corner together with the boxes.
+        points = np.concatenate([points, [[image_shape[1], image_shape[0]]]])
+
+    # Augment the corners of all the boxes in a single call.
+    if len(points) > 0:
+        points = augmenter.augment_keypoints(
+            imgaug.KeypointsOnImage.from_xy_array(points, shape=image_shape)).to_xy_array()
+    if image is None:
+        width_augmented, height_augmented = points[-1]
         image_augmented_shape = (height_augmented, width_augmented)
-
-    def box_inside_image(box):
-        area_before = cv2.contourArea(np.int32(box)[:, np.newaxis, :])
-        if area_before == 0:
-            return False, box
-        clipped = box.copy()
-        clipped[:, 0] = clipped[:, 0].clip(0, image_augmented_shape[1])
-        clipped[:, 1] = clipped[:, 1].clip(0, image_augmented_shape[0])
-        area_after = cv2.contourArea(np.int32(clipped)[:, np.newaxis, :])
-        return ((area_after / area_before) >= area_threshold) and (min_area is None or
-                                                                   area_after > min_area), clipped
-
-    def augment_box(box):
-        return augmenter.augment_keypoints(
-            imgaug.KeypointsOnImage.from_xy_array(box, shape=image_shape)).to_xy_array()
+        points = points[:-1]
+
+    # Clip the augmented boxes to the augmented image and keep
+    # the ones that are still sufficiently inside it.
+    augmented = points.reshape(-1, 4, 2)
+    clipped = augmented.copy()
+    clipped[..., 0] = clipped[..., 0].clip(0, image_augmented_shape[1])
+    clipped[..., 1] = clipped[..., 1].clip(0, image_augmented_shape[0])
+    area_before = get_polygon_areas(augmented)
+    area_after = get_polygon_areas(clipped)
+    inside = (area_before > 0) & (area_after >= area_threshold * area_before)
+    if min_area is not None:
+        inside &= area_after > min_area
 
     if boxes_format == 'boxes':
-        boxes_augmented = [
-            box for inside, box in [box_inside_image(box) for box in map(augment_box, boxes)]
-            if inside
-        ]
+        boxes_augmented = list(clipped[inside])
     elif boxes_format == 'lines':
-        boxes_augmented = [[(augment_box(box), character) for box, character in line]
-                           for line in boxes]
-        boxes_augmented = [[(box, character)
-                            for (inside, box), character in [(box_inside_image(box), character)
-                                                             for box, character in line] if inside]
-                           for line in boxes_augmented]
-        # Sometimes all the characters in a line are removed.
-        boxes_augmented = [line for line in boxes_augmented if line]
-    elif boxes_format == 'predictions':
-        boxes_augmented = [(word, augment_box(box)) for word, box in boxes]
-        boxes_augmented = [(word, box) for word, (inside, box) in [(word, box_inside_image(box))
-                                                                   for word, box in boxes_augmented]
-                           if inside]
+        boxes_augmented = []
+        index = 0
+        for line in boxes:
+            line_augmented = []
+            for _, character in line:
+                if inside[index]:
+                    line_augmented.append((clipped[index], character))
+                index += 1
+            # Sometimes all the characters in a line are removed.
+            if line_augmented:
+                boxes_augmented.append(line_augmented)
     else:
-        raise NotImplementedError(f'Unsupported boxes format: {boxes_format}')
+        boxes_augmented = [(word, box) for (word, _), box, keep in zip(boxes, clipped, inside)
+                           if keep]
     return image_augmented, boxes_augmented
 
 
@@ -327,7 +463,7 @@ def pad(image, width: int, height: int, cval: int = 255):
         output_shape = (height, width)
     assert height >= output_shape[0], 'Input height must be less than output height.'
     assert width >= output_shape[1], 'Input width must be less than output width.'
-    padded = np.zeros(output_shape, dtype=image.dtype) + cval
+    padded = np.full(output_shape, cval, dtype=image.dtype)
     padded[:image.shape[0], :image.shape[1]] = image
     return padded
 
@@ -348,7 +484,8 @@ def resize_image(image, max_scale, max_size):
         # We are contrained by scale
         scale = max_scale
     return cv2.resize(image,
-                      dsize=(int(image.shape[1] * scale), int(image.shape[0] * scale))), scale
+                      dsize=(int(image.shape[1] * scale), int(image.shape[0] * scale)),
+                      interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR), scale
 
 
 # pylint: disable=too-many-arguments
@@ -382,12 +519,18 @@ def fit(image, width: int, height: int, cval: int = 255, mode='letterbox', retur
         resize_width = scale * image.shape[1]
     if fitted is None:
         resize_width, resize_height = map(int, [resize_width, resize_height])
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        image = cv2.resize(image, dsize=(resize_width, resize_height), interpolation=interpolation)
         if mode == 'letterbox':
-            fitted = np.zeros((height, width, 3), dtype='uint8') + cval
-            image = cv2.resize(image, dsize=(resize_width, resize_height))
-            fitted[:image.shape[0], :image.shape[1]] = image[:height, :width]
+            image = image[:height, :width]
+            fitted = cv2.copyMakeBorder(image,
+                                        top=0,
+                                        bottom=height - image.shape[0],
+                                        left=0,
+                                        right=width - image.shape[1],
+                                        borderType=cv2.BORDER_CONSTANT,
+                                        value=get_border_value(cval, image))
         elif mode == 'crop':
-            image = cv2.resize(image, dsize=(resize_width, resize_height))
             fitted = image[:height, :width]
         else:
             raise NotImplementedError(f'Unsupported mode: {mode}')
@@ -421,6 +564,11 @@ def read_and_fit(filepath_or_array: typing.Union[str, np.ndarray],
 
 def sha256sum(filename):
     """Compute the sha256 hash for a file."""
+    if hasattr(hashlib, 'file_digest'):
+        # Python 3.11+ hashes the file in an optimized loop
+        # without copying each chunk into Python.
+        with open(filename, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
     h = hashlib.sha256()
     b = bytearray(128 * 1024)
     mv = memoryview(b)
@@ -430,6 +578,37 @@ def sha256sum(filename):
     return h.hexdigest()
 
 
+def _get_sha256_cache(filename):
+    stat = os.stat(filename)
+    return f'{stat.st_mtime_ns}:{stat.st_size}', filename + '.sha256'
+
+
+def cache_sha256sum(filename, digest):
+    """Store the sha256 hash for a file in a sidecar `.sha256` file
+    so that `cached_sha256sum` does not need to recompute it."""
+    key, sidecar = _get_sha256_cache(filename)
+    try:
+        with open(sidecar, 'w') as f:
+            f.write(f'{key} {digest}')
+    except OSError:
+        pass
+
+
+def cached_sha256sum(filename):
+    """Compute the sha256 hash for a file, reusing the hash stored in a
+    sidecar `.sha256` file if the file has not changed since it was
+    last hashed."""
+    key, sidecar = _get_sha256_cache(filename)
+    if os.path.isfile(sidecar):
+        with open(sidecar, 'r') as f:
+            cached = f.read().split()
+        if len(cached) == 2 and cached[0] == key:
+            return cached[1]
+    digest = sha256sum(filename)
+    cache_sha256sum(filename, digest)
+    return digest
+
+
 def get_default_cache_dir():
     return os.environ.get('KERAS_OCR_CACHE_DIR', os.path.expanduser(os.path.join('~',
                                                                                  '.keras-ocr')))
@@ -457,11 +636,18 @@ def download_and_verify(url, sha256=None, cache_dir=None, verbose=True, filename
     os.makedirs(os.path.split(filepath)[0], exist_ok=True)
     if verbose:
         print('Looking for ' + filepath)
-    if not os.path.isfile(filepath) or (sha256 and sha256sum(filepath) != sha256):
+    if not os.path.isfile(filepath) or (sha256 and cached_sha256sum(filepath) != sha256):
         if verbose:
             print('Downloading ' + filepath)
-        urllib.request.urlretrieve(url, filepath)
-    #assert sha256 is None or sha256 == sha256sum(filepath), 'Error occurred verifying sha256.'
+        # Hash the file while it streams to disk rather than reading
+        # it back afterwards.
+        h = hashlib.sha256()
+        with urllib.request.urlopen(url) as response, open(filepath, 'wb') as f:
+            for chunk in iter(lambda: response.read(1 << 20), b''):
+                f.write(chunk)
+                h.update(chunk)
+        cache_sha256sum(filepath, h.hexdigest())
+        #assert sha256 is None or sha256 == h.hexdigest(), 'Error occurred verifying sha256.'
     return filepath
 
 
@@ -477,43 +663,61 @@ def get_rotated_box(
         top-right, bottom-right, bottom-left order along
         with the angle of rotation about the bottom left corner.
     """
+    from shapely import geometry
     try:
         mp = geometry.MultiPoint(points=points)
         pts = np.array(list(zip(*mp.minimum_rotated_rectangle.exterior.xy)))[:-1]  # noqa: E501
     except AttributeError:
         # There weren't enough points for the minimum rotated rectangle function
         pts = points
+    pts = np.asarray(pts, dtype='float64')
+    if pts.shape != (4, 2):
+        # _order_points is compiled without bounds checks
+        raise ValueError(f'Expected four (x, y) points, got an array of shape {pts.shape}.')
+    return _order_points(pts)
+
+
+@njit(cache=True, error_model='numpy')
+def _order_points(pts):
     # The code below is taken from
     # https://github.com/jrosebr1/imutils/blob/master/imutils/perspective.py
 
     # sort the points based on their x-coordinates
-    xSorted = pts[np.argsort(pts[:, 0]), :]
+    xSorted = pts[np.argsort(pts[:, 0], kind='mergesort')]
 
     # grab the left-most and right-most points from the sorted
     # x-roodinate points
-    leftMost = xSorted[:2, :]
-    rightMost = xSorted[2:, :]
+    leftMost = xSorted[:2]
+    rightMost = xSorted[2:]
 
     # now, sort the left-most coordinates according to their
     # y-coordinates so we can grab the top-left and bottom-left
     # points, respectively
-    leftMost = leftMost[np.argsort(leftMost[:, 1]), :]
-    (tl, bl) = leftMost
+    leftMost = leftMost[np.argsort(leftMost[:, 1], kind='mergesort')]
+    tl, bl = leftMost[0], leftMost[1]
 
     # now that we have the top-left coordinate, use it as an
     # anchor to calculate the Euclidean distance between the
     # top-left and right-most points; by the Pythagorean
     # theorem, the point with the largest distance will be
     # our bottom-right point
-    D = spatial.distance.cdist(tl[np.newaxis], rightMost, "euclidean")[0]
-    (br, tr) = rightMost[np.argsort(D)[::-1], :]
+    d0 = math.hypot(rightMost[0, 0] - tl[0], rightMost[0, 1] - tl[1])
+    d1 = math.hypot(rightMost[1, 0] - tl[0], rightMost[1, 1] - tl[1])
+    if d0 > d1:
+        br, tr = rightMost[0], rightMost[1]
+    else:
+        br, tr = rightMost[1], rightMost[0]
 
     # return the coordinates in top-left, top-right,
     # bottom-right, and bottom-left order
-    pts = np.array([tl, tr, br, bl], dtype="float32")
+    ordered = np.empty((4, 2), dtype=np.float32)
+    ordered[0] = tl
+    ordered[1] = tr
+    ordered[2] = br
+    ordered[3] = bl
 
-    rotation = np.arctan((tl[0] - bl[0]) / (tl[1] - bl[1]))
-    return pts, rotation
+    rotation = math.atan((tl[0] - bl[0]) / (tl[1] - bl[1]))
+    return ordered, rotation
 
 
 def fix_line(line):
@@ -540,23 +744,30 @@ def fix_line(line):
 
 class ComputeInputLayer(tf.keras.layers.Layer):
 
+    def __init__(self):
+        super(ComputeInputLayer, self).__init__()
+
+        mean = np.array([123.6, 116.3, 103.5])  # * 255
+        variance = np.array([58.3, 57.12, 57.38])  # * 255
+
+        # (input - mean) / variance folded into a single multiply-add
+        self.scale = tf.constant(1.0 / variance, dtype=tf.float32)
+        self.bias = tf.constant(-mean / variance, dtype=tf.float32)
+
     def call(self, input):
         # input = tf.image.resize(input, (1080, 500)) # not for production!!!!
+        # uint8 images are cast here, on device
 
-        mean = tf.constant([123.6, 116.3, 103.5])
-        variance = tf.constant([58.3, 57.12, 57.38])
-
-        input -= mean  # * 255
-        input /= variance  # * 255
-        return input
+        return tf.cast(input, tf.float32) * self.scale + self.bias
 
 
 class BboxLayer(tf.keras.layers.Layer):
     # def __init__(self, num_outputs):
     def __init__(self):
-        # for dilation
+        # for dilation; a flat structuring element keeps the
+        # dilated component masks binary.
 
-        self.filters = tf.ones([3, 3, 1], dtype=tf.float32)
+        self.filters = tf.zeros([3, 3, 1], dtype=tf.float32)
         self.strides = [1., 1., 1., 1.]
         self.padding = "SAME"
         self.dilations = [1., 2., 2., 1.]
@@ -566,32 +777,26 @@ class BboxLayer(tf.keras.layers.Layer):
         # pass
 
     def get_bboxes(self, input):
-        # : Tensor where every layer is single dlated connected component area
-        # input = tf.cast(input, tf.float32)
-        coords_tensor_y = tf.where(tf.argmax(input, axis=0))
-        coords_tensor_x = tf.where(tf.argmax(input, axis=1))
-
-        y1 = tf.reduce_max(coords_tensor_y)
-        y2 = tf.reduce_min(coords_tensor_y)
-
-        x1 = tf.reduce_max(coords_tensor_x)
-        x2 = tf.reduce_min(coords_tensor_x)
-
-        w = x1 - x2
-        h = y1 - y2
-
-        x2 = tf.cast(x2, tf.int32)
-        y2 = tf.cast(y2, tf.int32)
-        w = tf.cast(w, tf.int32)
-        h = tf.cast(h, tf.int32)
-        '''
-
-        x2 = tf.cast(x2, tf.float32)
-        y2 = tf.cast(y2, tf.float32)
-        w = tf.cast(w, tf.float32)
-        h = tf.cast(h, tf.float32)
-        '''
-        return x2, y2, w, h  ##!!!
+        # : Tensor [... x H x W] where every layer is single dlated connected component area
+        # returns y, x, h, w tensors of shape [...]; empty layers get (0, 0, 1, 1)
+        # project the masks onto rows and columns once, then find the
+        # first and last occupied index of each projection
+        rows = tf.cast(tf.reduce_any(input > 0, axis=-1), tf.int32)
+        cols = tf.cast(tf.reduce_any(input > 0, axis=-2), tf.int32)
+        height = array_ops.shape(rows)[-1]
+        width = array_ops.shape(cols)[-1]
+
+        y1 = tf.argmax(rows, axis=-1, output_type=tf.int32)
+        y2 = height - 1 - tf.argmax(tf.reverse(rows, axis=[-1]), axis=-1, output_type=tf.int32)
+        x1 = tf.argmax(cols, axis=-1, output_type=tf.int32)
+        x2 = width - 1 - tf.argmax(tf.reverse(cols, axis=[-1]), axis=-1, output_type=tf.int32)
+
+        empty = tf.reduce_max(rows, axis=-1) == 0
+        y = tf.where(empty, 0, y1)
+        x = tf.where(empty, 0, x1)
+        h = tf.where(empty, 1, y2 - y1)
+        w = tf.where(empty, 1, x2 - x1)
+        return y, x, h, w
 
     '''
     def get_bboxes(self, input):
@@ -612,16 +817,6 @@ class BboxLayer(tf.keras.layers.Layer):
         return y2, x2, h, w   
     '''
 
-    def get_bboxes_batch(self, input):
-        bbox_batch = tf.map_fn(fn=self.get_bboxes,
-                               elems=input,
-                               dtype=(tf.int32, tf.int32, tf.int32, tf.int32)
-                               # dtype=(tf.float32, tf.float32, tf.float32, tf.float32 )
-
-                               )
-
-        return bbox_batch
-
     def dlate_connected_components(self, input):
         dlate_component = tf.nn.dilation2d(input,
                                            self.filters,
@@ -633,28 +828,12 @@ class BboxLayer(tf.keras.layers.Layer):
 
         return dlate_component
 
-    def expand_img(self, img):
-        exp = tf.ones(self.elem_num, dtype=tf.float32)
-
-        return tf.tensordot(exp, img, axes=0)
-
     def clear_coords(self, xyhw):
         # : input - raw list of xyhw tensors
 
         index = tf.math.logical_and(xyhw[:, :, 2] < 300, xyhw[:, :, 2] > 4)
         return xyhw[index]
 
-    def produce_connected_components_batch(self, input):
-        components_vector = tf.range(1, input[1] + 1)
-
-        return tf.tensordot(components_vector, tf.ones_like(input[0], tf.int32), axes=0)
-
-    def produce_image_batch(self, input):
-        bbox_dimention = tf.ones([self.elem_num], tf.int32)  # tf.range(1, 55)
-
-        # return tf.tensordot(tf.ones(([self.elem_num], tf.int32)), input, axes=0)
-        return tf.tensordot(bbox_dimention, input, axes=0)
-
     def call(self, input):
         textmap = input[:, :, :, 0]
 
@@ -666,42 +845,28 @@ class BboxLayer(tf.keras.layers.Layer):
         linkmap = tf.where(linkmap > 0.4, 1.0, 0)
         res_img = tf.clip_by_value((textmap + linkmap), 0, 1)
 
+        from tensorflow_addons import image as image_tfa
         res_img = tf.map_fn(fn=image_tfa.connected_components, elems=res_img, dtype=tf.int32)
-        res_img_shape = array_ops.shape(res_img)
 
         elem_num = tf.reduce_max(res_img) + 1
         self.elem_num = elem_num
 
-        # create [batch x elem_num(max value)]
-        elem_num = tf.ones(res_img_shape[0], tf.int32) * elem_num
-
-        # separate connected components to different layers
-
-        components_ids_matrix = tf.map_fn(fn=self.produce_connected_components_batch, elems=[res_img, elem_num],
-                                          dtype=tf.int32)
-
-        connected_components_img_matrix = tf.map_fn(fn=self.produce_image_batch, elems=res_img,
-                                                    dtype=tf.int32)  # tf.where(components_ids_matrix == res_img, 1., 0.)
-        # Transform connected components image to matrix [batch x elem_num x H x W]
-
-        connected_components_img_matrix = tf.where(components_ids_matrix == connected_components_img_matrix, 1., 0.)
+        # separate connected components to different layers:
+        # [batch x elem_num x H x W] mask, one layer per component id
+        components_ids = tf.range(1, elem_num + 1)
+        connected_components_img_matrix = tf.cast(
+            res_img[:, tf.newaxis, :, :] == components_ids[tf.newaxis, :, tf.newaxis, tf.newaxis],
+            tf.float32)
 
-        # dlate every layers mask to increase bbox area
+        # dlate every layers mask to increase bbox area, all layers of
+        # all images in a single op
+        matrix_shape = array_ops.shape(connected_components_img_matrix)
+        dlated_components_batch = self.dlate_connected_components(
+            tf.reshape(connected_components_img_matrix, [-1, matrix_shape[2], matrix_shape[3], 1]))
+        dlated_components_batch = tf.reshape(dlated_components_batch, matrix_shape)
 
-        connected_components_img_matrix = tf.expand_dims(connected_components_img_matrix, -1)
-
-        dlated_components_batch = tf.map_fn(fn=self.dlate_connected_components, elems=connected_components_img_matrix,
-                                            dtype=tf.float32)[:, :, :, :, 0]
-
-        xyhw = tf.map_fn(fn=self.get_bboxes_batch,
-                         elems=dlated_components_batch,
-                         dtype=(tf.int32, tf.int32, tf.int32, tf.int32))
-
-        xyhw = tf.stack(xyhw)
-        xyhw = tf.map_fn(tf.transpose, xyhw, dtype=tf.int32)
-        xyhw = tf.transpose(xyhw)
-        # replace -1 for 0
-        xyhw = tf.where(xyhw == -1, 0, xyhw)
+        # [batch x elem_num x 4]
+        xyhw = tf.stack(self.get_bboxes(dlated_components_batch), axis=-1)
 
         return xyhw
 
@@ -720,46 +885,74 @@ class GrayScaleLayer(tf.keras.layers.Layer):
 
 class CropBboxesLayer(tf.keras.layers.Layer):  # (PreprocessingLayer):
 
-    def my_crop(self, inp, target_height=31,
-                target_width=200):
-        bbox = inp[1]
-        crop = tf.image.crop_to_bounding_box(inp[0], bbox[0], bbox[1], bbox[2], bbox[3])
-
-        # resize crop
-        scale = tf.math.minimum(target_width / bbox[3], target_height / bbox[2])
-        scale = tf.cast(scale, tf.float32)
-
-        scaled_shape = [tf.cast(bbox[2], tf.float32) * scale, tf.cast(bbox[3], tf.float32) * scale]
-
-        # calculate padding for target w, h
-        pad_h = target_height - tf.cast(scaled_shape[0], tf.int32)
-        pad_w = target_width - tf.cast(scaled_shape[1], tf.int32)
-        result_img = tf.image.resize(crop, scaled_shape)
-
-        result_img = tf.pad(result_img, [[pad_h, 0], [0, pad_w], [0, 0]], "CONSTANT", constant_values=0)
-
-        return result_img
-
-    def resize_crop(self, inputs):
-        ## for recognition ##
-
-        # inputs:55x500x1080x1 | 55x4
-        crop = tf.map_fn(fn=self.my_crop, elems=inputs, dtype=tf.float32)
-
-        return crop
-
-    def transform_inp_image(self, inputs):
-        # 3x500x1080x1 -> 3x55x500x1080x1
-
-        return tf.tensordot(tf.ones_like(inputs[1][:, 0], tf.float32), inputs[0], axes=0)
+    def __init__(self, target_height=31, target_width=200):
+        super(CropBboxesLayer, self).__init__()
+        self.target_height = target_height
+        self.target_width = target_width
+
+    def get_crop_boxes(self, bboxes, image_height, image_width):
+        # bboxes: [N x 4] y, x, h, w in image pixels
+        # Every crop is scaled to fit target size keeping its aspect ratio and is
+        # placed in the bottom left corner. Returns the normalized crop_and_resize
+        # boxes covering the whole target window along with the content size.
+        target_height = float(self.target_height)
+        target_width = float(self.target_width)
+        y, x, h, w = tf.unstack(tf.cast(bboxes, tf.float32), axis=-1)
+
+        scale = tf.math.minimum(target_width / w, target_height / h)
+        scaled_h = tf.math.maximum(tf.math.floor(h * scale), 1.)
+        scaled_w = tf.math.maximum(tf.math.floor(w * scale), 1.)
+        pad_h = target_height - scaled_h
+
+        # source pixels per output pixel; the corners of the content map onto
+        # the corners of the crop so sampling never leaves the bounding box
+        step_y = tf.math.divide_no_nan(h - 1, scaled_h - 1)
+        step_x = tf.math.divide_no_nan(w - 1, scaled_w - 1)
+        y2 = y + h - 1
+        y1 = y2 - (target_height - 1) * step_y
+        x1 = x
+        x2 = x1 + (target_width - 1) * step_x
+
+        image_height = tf.cast(image_height - 1, tf.float32)
+        image_width = tf.cast(image_width - 1, tf.float32)
+        boxes = tf.stack([y1 / image_height, x1 / image_width, y2 / image_height, x2 / image_width],
+                         axis=-1)
+        return boxes, pad_h, scaled_w
 
     def call(self, inputs):
         # inputs:[image, bboxes] | 3x500x1080x1, 3x55x4
-
-        transformed_input_images = tf.map_fn(fn=self.transform_inp_image, elems=inputs, dtype=tf.float32)
-
-        crops = tf.map_fn(fn=self.resize_crop, elems=[transformed_input_images, inputs[1] * 2], dtype=tf.float32)
-        return crops
+        images, bboxes = inputs
+        images_shape = array_ops.shape(images)
+        bboxes_shape = array_ops.shape(bboxes)
+        batch_size, elem_num = bboxes_shape[0], bboxes_shape[1]
+
+        # a one pixel border repeating the edges keeps sampling points that round
+        # to just outside the image from reading the zero extrapolation value
+        images = tf.pad(images, [[0, 0], [1, 1], [1, 1], [0, 0]], mode='SYMMETRIC')
+
+        # all boxes of all images are cropped and resized in a single op
+        boxes, pad_h, scaled_w = self.get_crop_boxes(
+            tf.reshape(bboxes * 2 + tf.constant([1, 1, 0, 0], dtype=bboxes.dtype), [-1, 4]),
+            images_shape[1] + 2, images_shape[2] + 2)
+        box_indices = tf.repeat(tf.range(batch_size), elem_num)
+        crops = tf.image.crop_and_resize(images,
+                                         boxes,
+                                         box_indices, [self.target_height, self.target_width],
+                                         extrapolation_value=0)
+
+        # blank the padding above and to the right of every crop
+        rows = tf.range(self.target_height, dtype=tf.float32)
+        cols = tf.range(self.target_width, dtype=tf.float32)
+        mask = tf.math.logical_and(
+            rows[tf.newaxis, :, tf.newaxis] >= pad_h[:, tf.newaxis, tf.newaxis],
+            cols[tf.newaxis, tf.newaxis, :] < scaled_w[:, tf.newaxis, tf.newaxis])
+        crops = tf.where(mask[..., tf.newaxis], crops, 0.)
+        # patches are kept as uint8 till the recognizer input, 4x less memory traffic
+        crops = tf.cast(tf.round(tf.clip_by_value(crops * 255., 0., 255.)), tf.uint8)
+
+        # [batch x elem_num x target_height x target_width x channels] uint8
+        return tf.reshape(
+            crops, [batch_size, elem_num, self.target_height, self.target_width, images_shape[3]])
 
 
 class DecodeCharLayer(tf.keras.layers.Layer):
@@ -775,45 +968,43 @@ class DecodeCharLayer(tf.keras.layers.Layer):
 
 class DecodeBoxLayer(tf.keras.layers.Layer):
 
-    def decode_one_bbox(self, bboxes):
-        x1, x2, y1, y2 = bboxes[1] * 2, (bboxes[1] + bboxes[3]) * 2, bboxes[0] * 2, (bboxes[0] + bboxes[2]) * 2
-
-        return tf.stack([[x1, y1],
-                         [x2, y1],
-                         [x2, y2],
-                         [x1, y2]])
-
-    def decode_one_image_bboxes(self, bboxes):
-        # return tf.map_fn(fn=self.decode_one_bbox, elems=bboxes, dtype=[[tf.int32, tf.int32], [tf.int32, tf.int32], [tf.int32, tf.int32], [tf.int32, tf.int32]])
-        return tf.map_fn(fn=self.decode_one_bbox, elems=bboxes, dtype=tf.int32)
-
     def call(self, input):
-        return tf.map_fn(fn=self.decode_one_image_bboxes, elems=input, dtype=tf.int32)
-        # return tf.map_fn(fn=self.decode_one_image_bboxes, elems=input,
-        # dtype=[[tf.int32, tf.int32], [tf.int32, tf.int32], [tf.int32, tf.int32], [tf.int32, tf.int32]])
+        # [batch x num_bbox x 4] y, x, h, w -> [batch x num_bbox x 4 x 2] corner coords
+        x1, x2 = input[..., 1] * 2, (input[..., 1] + input[..., 3]) * 2
+        y1, y2 = input[..., 0] * 2, (input[..., 0] + input[..., 2]) * 2
+
+        return tf.stack([
+            tf.stack([x1, y1], axis=-1),
+            tf.stack([x2, y1], axis=-1),
+            tf.stack([x2, y2], axis=-1),
+            tf.stack([x1, y2], axis=-1)
+        ],
+                        axis=-2)
 
 
 class BatchRecognizeLayer(tf.keras.layers.Layer):
 
-    def __init__(self, recognizer, prob_score_display):
+    def __init__(self, recognizer):
+        # recognizer returns [labels, prob_score]
         super(BatchRecognizeLayer, self).__init__()
         self.recognizer = recognizer
-        self.prob_score_display = prob_score_display
 
     def call(self, input):
-        # input: (cropped bbox batch, recognizer)
+        # input: cropped bbox batch (BATCH x Num_BBOX x H x W x C)
 
         bboxes = input
-        if self.prob_score_display:
-            rec_batch = tf.map_fn(fn=self.recognizer, elems=bboxes,
-                                  dtype=[tf.int64, tf.float32])  # return [bbox, prob_score]
-
-            return rec_batch
+        batch_size, elem_num = tf.shape(bboxes)[0], tf.shape(bboxes)[1]
+        # run the recognizer once over all crops of the batch
+        flat_bboxes = tf.reshape(bboxes, (-1, ) + tuple(self.recognizer.input_shape[1:]))
+        if flat_bboxes.dtype == tf.uint8:
+            # uint8 patches from CropBboxesLayer
+            flat_bboxes = tf.cast(flat_bboxes, tf.float32) / 255.
+        labels, prob_score = self.recognizer(flat_bboxes)  # return [bbox, prob_score]
+        prob_score = tf.reshape(
+            prob_score,
+            tf.concat([[batch_size, elem_num], tf.shape(prob_score)[1:]], axis=0))
 
-        else:
-            rec_batch = tf.map_fn(fn=self.recognizer, elems=bboxes, dtype=tf.int64)
-
-            return rec_batch
+        return [tf.reshape(labels, [batch_size, elem_num, -1]), prob_score]
 
 
 def get_recognition_part(weights, recognizer_alphabet, build_params):
@@ -827,67 +1018,121 @@ def get_recognition_part(weights, recognizer_alphabet, build_params):
     return prediction_model, ctc_model
 
 
-def create_one_grap_model(detector_weights, recognizer_weights, recognizer_alphabet, prod=False,
-                          build_params=recognition.DEFAULT_BUILD_PARAMS):
-    # if debug - output bbox images, not rectangles
-    # build_params - for recognition part
-
-    ## model_mode -- 0 - return prediction_model, 1-return ctc+probability
+@functools.lru_cache(maxsize=4)
+def _cached_recognition_part(weights, weights_stat, recognizer_alphabet, build_params):
+    # build_params - sorted (key, value) pairs, to be hashable
+    # weights_stat - (mtime_ns, size) of the weights file, so that a
+    # rewritten file is loaded again instead of reusing the old weights
+    del weights_stat
+    return get_recognition_part(weights, recognizer_alphabet, dict(build_params))
 
-    recognizer_predict_model = get_recognition_part(recognizer_weights, recognizer_alphabet, build_params)[int(prod)]
-    # recognition part return 2 models. First is for debug(prod=False), second for production (prod=True)
 
-    detector = detection.Detector(weights='clovaai_general')
-
-    detector.model.load_weights(detector_weights)
+def create_one_grap_model(detector_weights,
+                          recognizer_weights,
+                          recognizer_alphabet,
+                          prod=False,
+                          build_params=recognition.DEFAULT_BUILD_PARAMS,
+                          input_size=None):
+    # if debug - output bbox images, not rectangles
+    # build_params - for recognition part
+    # input_size - (height, width) to resize uint8 input images to inside the graph
+
+    # prod - also output prob_score (production), otherwise decoded [4, 2] bboxes (debug)
+
+    build_params = tuple(
+        sorted((key, tuple(value) if isinstance(value, list) else value)
+               for key, value in build_params.items()))
+    weights_stat = os.stat(recognizer_weights)
+    recognizer_predict_model = _cached_recognition_part(
+        recognizer_weights, (weights_stat.st_mtime_ns, weights_stat.st_size), recognizer_alphabet,
+        build_params)[1]
+    # recognition part return 2 models, the second one (ctc+probability) is used in both modes
+
+    # weights are loaded once: either the default ones (detector_weights=None)
+    # or detector_weights, without downloading the default ones first
+    if detector_weights is None:
+        detector = detection.Detector(weights='clovaai_general')
+    else:
+        detector = detection.Detector(weights=None)
+        detector.model.load_weights(detector_weights)
 
-    rec_inp = tf.keras.Input([None, None, 3])
-    normilized_inp = ComputeInputLayer()(rec_inp)
+    rec_inp = tf.keras.Input([None, None, 3], dtype=tf.uint8)
+    image_inp = rec_inp
+    if input_size is not None:
+        image_inp = keras.layers.Lambda(lambda x: tf.image.resize(x, input_size),
+                                        name='input_resize')(rec_inp)
+    normilized_inp = ComputeInputLayer()(image_inp)
 
     bbox_model = detector.model(normilized_inp)
 
     bbox_model = BboxLayer()(bbox_model)
 
-    grayscale_model = GrayScaleLayer()(rec_inp)
+    grayscale_model = GrayScaleLayer()(image_inp)
 
     bboxes_model = CropBboxesLayer()([grayscale_model, bbox_model])  # cropped patches (BATCH x Num_BBOX x 31 x 200)
 
-    if prod:
+    labels, prob_score = BatchRecognizeLayer(recognizer_predict_model)(bboxes_model)
 
-        batch_rec_layer = BatchRecognizeLayer(recognizer_predict_model,
-                                              prob_score_display=True)  # create layer with prob_score display
-        batch_rec_layer = batch_rec_layer(bboxes_model)
+    if prod:
         # xyhw bbox format
-        return keras.models.Model(inputs=rec_inp, outputs=[batch_rec_layer, bbox_model])
+        return keras.models.Model(inputs=rec_inp, outputs=[[labels, prob_score], bbox_model])
 
     else:
-        batch_rec_layer = BatchRecognizeLayer(recognizer_predict_model, prob_score_display=False)  # create layer
-        batch_rec_layer = batch_rec_layer(bboxes_model)
+        # prob_score is not needed for debug
         decoded_bboxes = DecodeBoxLayer()(bbox_model)
-        return keras.models.Model(inputs=rec_inp,
-                                  outputs=[[batch_rec_layer], decoded_bboxes])  # result for  [[4,2]] bbox shape
+        # result for  [[4,2]] bbox shape
+        return keras.models.Model(inputs=rec_inp, outputs=[[labels], decoded_bboxes])
 
 
 # create pipeline from one graph model
 
 class OneGraphPipeline():
+    _mean = np.array([0.485, 0.456, 0.406], dtype='float32')
+    _inv_variance = 1 / np.array([0.229, 0.224, 0.225], dtype='float32')
+
     def __init__(self, model, alphabet):
         self.model = model
         self.blank_label_idx = len(alphabet)
         self.alphabet = alphabet
+        # blank label maps to an empty string
+        self._alphabet_arr = np.array(list(alphabet) + [''])
+        # (height, width) the model resizes its input to, None if it does not
+        self.input_size: typing.Optional[typing.Tuple[int, ...]]
+        try:
+            self.input_size = tuple(model.get_layer('input_resize').output_shape[1:3])
+        except ValueError:
+            self.input_size = None
+        # traced once, avoids the per call overhead of model.predict
+        self._predict = tf.function(
+            self._infer, input_signature=[tf.TensorSpec([None, None, None, 3], model.input.dtype)])
+
+    def _infer(self, images):
+        (labels, *prob_score), bboxes = self.model(images, training=False)
+        if prob_score:
+            # reduce [B, N, T, C] probs to one probability per box in graph:
+            # product of the max probs of all recognized chars
+            prob_score = [
+                tf.reduce_prod(tf.cast(tf.reduce_max(prob_score[0], axis=-1), tf.float64), axis=-1)
+            ]
+
+        return [[labels] + prob_score, bboxes]
 
     def decode_prediction(self, raw_predict):  # from numerical to char groups
+        raw_predict = np.asarray(raw_predict)
+        # padding (-1) is decoded as blank
+        raw_predict = np.where(raw_predict < 0, self.blank_label_idx, raw_predict)
+        chars = self._alphabet_arr[raw_predict]
 
-        predictions = [
-            ''.join([self.alphabet[idx] for idx in row if idx not in [self.blank_label_idx, -1]])
-            for row in raw_predict
-        ]
-
-        return predictions
+        return [''.join(row) for row in chars]
 
     def decode_batch_prediction(self, batch_raw_predict):
+        # decode [B, N, T] at once, then split back into B groups of N
+        batch_raw_predict = np.asarray(batch_raw_predict)
+        batch_size, elem_num = batch_raw_predict.shape[:2]
+        predictions = self.decode_prediction(
+            batch_raw_predict.reshape((batch_size * elem_num, ) + batch_raw_predict.shape[2:]))
 
-        return [self.decode_prediction(raw) for raw in batch_raw_predict]
+        return [predictions[i * elem_num:(i + 1) * elem_num] for i in range(batch_size)]
 
     def get_prediction_groups(self, bboxes, char_groups):
         return [
@@ -900,51 +1145,38 @@ class OneGraphPipeline():
     def compute_input(self, image):
         # should be RGB order
         # image = image.astype('float32')
-        mean = np.array([0.485, 0.456, 0.406])
-        variance = np.array([0.229, 0.224, 0.225])
-
-        image -= mean
-        image /= variance
+        np.subtract(image, self._mean, out=image)
+        np.multiply(image, self._inv_variance, out=image)
         return image
 
-    def _max_val_index(self, array):
-
-        # to calc max prob index from array
-
-        return np.argmax(array)
-
-    def _convert_to_chargroup(self, prob_score_batch):
-
-        # convert array with prob to list with index letter and number prob list
-        batch = []
-        for probability_array in prob_score_batch:
-            probability_list = []
-
-            for box in probability_array:
-                probability = 1
-                for j in box:
-                    index = self._max_val_index(j)
-                    probability *= j[
-                        index]  # to calculate overall probability we multyply probs of all recognized chars
-                probability_list += [probability]
-            batch.append(probability_list)
-
-        return batch
-
     def _get_triple_prediction_groups(self, bboxes, char_groups, probability):
         return [list(zip(predictions, boxes, probability)) for predictions, boxes, \
                                                                probability in
                 zip(char_groups, bboxes, probability)]
 
-    def recognize(self, images):
+    def _predict_numpy(self, images):
+        raw_predict = self._predict(tf.cast(images, self.model.input.dtype))
+
+        return tf.nest.map_structure(lambda x: x.numpy(), raw_predict)
+
+    def recognize(self, images, batch_size=32):
         # images = self.compute_input(images)
+        # split into batches as model.predict did, all images at once may not fit in memory
 
-        raw_predict = self.model.predict([images])
-        char_groups = self.decode_batch_prediction(raw_predict[0][0])
+        prediction_groups = []
+        for start in range(0, len(images), batch_size):
+            raw_predict = self._predict_numpy(images[start:start + batch_size])
+            char_groups = self.decode_batch_prediction(raw_predict[0][0])
+            prediction_groups.extend(self.get_prediction_groups(raw_predict[1], char_groups))
+
+        return prediction_groups
+
+    def recognize_batch(self, images_list):
+        # images of the same size, returns prediction groups per image
 
-        return self.get_prediction_groups(raw_predict[1], char_groups)
+        return self.recognize(np.stack(images_list))
 
-    def recognize_with_probability(self, images):
+    def recognize_with_probability(self, images, batch_size=32):
         # predict
         '''
         prediction = self.model.predict([images])
@@ -954,13 +1186,18 @@ class OneGraphPipeline():
         char_groups = self.decode_batch_prediction(raw_predict[0][0])
         # make triple prediction groups
         '''
-        raw_predict = self.model.predict([images])
+        # return probability_groups #self._get_triple_prediction_groups(prediction[1], char_groups, probability_groups)
+        prediction_groups = []
+        for start in range(0, len(images), batch_size):
+            raw_predict = self._predict_numpy(images[start:start + batch_size])
 
-        char_groups = self.decode_batch_prediction(raw_predict[0][0])
-        probability_groups = self._convert_to_chargroup(raw_predict[0][1])
+            char_groups = self.decode_batch_prediction(raw_predict[0][0])
+            probability_groups = raw_predict[0][1].tolist()  # already reduced per box in graph
 
-        # return probability_groups #self._get_triple_prediction_groups(prediction[1], char_groups, probability_groups)
-        return self._get_triple_prediction_groups(raw_predict[1], char_groups, probability_groups)
+            prediction_groups.extend(
+                self._get_triple_prediction_groups(raw_predict[1], char_groups, probability_groups))
+
+        return prediction_groups
 
 
 def initialize_image_ops():
@@ -981,49 +1218,53 @@ def initialize_image_ops():
 
 # check precision part
 
+
+def _object_bb(obj):
+    # (ключ, координаты 4x2) одного объекта
+    value = obj.findtext('attributes').split('=')[1]
+    coord = np.fromiter((float(pt.findtext(c)) for pt in obj.iterfind('polygon/pt') for c in 'xy'),
+                        dtype='float64')
+    return value, coord.astype('int32').reshape(-1, 2)[:4]
+
+
 def objects_bb(xml_file, object_name):
-    "    возвращает список словарей с координтами.\
+    "    возвращает список пар (ключ, координаты 4x2).\
     для объектов мани, кардс , озер.\
     "
     tree = ElementTree.parse(xml_file)
     root = tree.getroot()
-    list_box = []
-    for i in root:
-        b_boxes = {}
-        if i.tag == 'object' and i[0].text \
-                == object_name:
-            for el in i:
-                values = []
-                if el.tag == 'attributes':
-                    value = el.text.split('=')[1]
-                    values += [value]
-                elif el.tag == 'polygon':
-                    coord = []
-                    for j in el:
-                        if j.tag == "pt":
-                            point = []
-                            for c in j:
-                                if c.tag == 'x' or c.tag == 'y':
-                                    point += [int(float(c.text))]
-                            coord += [point]
-            b_boxes[values[-1]] = ([coord[0][0], coord[0][1]], \
-                                   [coord[1][0], coord[1][1]],
-                                   [coord[2][0], coord[2][1]],
-                                   [coord[3][0], coord[3][1]])
-            list_box += [b_boxes]
-
-    return list_box
+    return [_object_bb(obj) for obj in root.iterfind("object[name='%s']" % object_name)]
 
 
 def got_gt_objects(xml_file):
-    "возвращает три набора бб"
-    cards = objects_bb(xml_file, 'cards')
-    for i in cards:  # drop single suits
-        if len(list(i)[0]) == 1:
-            cards.remove(i)
-    money = objects_bb(xml_file, 'money')
-    other = objects_bb(xml_file, 'other')
-    return [cards, money, other]
+    "возвращает три набора бб, хмл читается один раз"
+    tree = ElementTree.parse(xml_file)
+    root = tree.getroot()
+    gt_objects: typing.Dict[str, typing.List[typing.Tuple[str, np.ndarray]]] = {
+        'cards': [],
+        'money': [],
+        'other': []
+    }
+    for obj in root.iterfind('object'):
+        name = obj.findtext('name')
+        if name in gt_objects:
+            gt_objects[name].append(_object_bb(obj))
+    # drop single suits
+    cards = [(key, coord) for key, coord in gt_objects['cards'] if len(key) != 1]
+    return [cards, gt_objects['money'], gt_objects['other']]
+
+
+@njit(cache=True)
+def _count_correct(gt_xy, gt_key_ids, pred_xy, pred_key_ids, delta):
+    # сравнивает левые верхние точки пар с одинаковым ключом
+    correct_answer = 0
+    for i in range(gt_xy.shape[0]):
+        for j in range(pred_xy.shape[0]):
+            if gt_key_ids[i] == pred_key_ids[j] \
+                    and abs(pred_xy[j, 0] - gt_xy[i, 0]) <= delta \
+                    and abs(pred_xy[j, 1] - gt_xy[i, 1]) <= delta:
+                correct_answer += 1
+    return correct_answer
 
 
 def precision(gt_object, predict):
@@ -1033,33 +1274,14 @@ def precision(gt_object, predict):
     текстом из предикта и условию наложения левой\
     верхней точки координат предикта и граунд тру"
 
-    def compare_difference(number_a, number_b):
-        "сравнивает координаты для\
-        определения наложения точек"
-        delta = 10
-        max_first = max(number_a, number_b)
-        min_first = min(number_a, number_b)
-        if min_first + delta >= max_first:
-            return True
-        else:
-            return False
-
-            # predict = predict[0]
+    key_ids: typing.Dict[str, int] = {}
+    gt_key_ids = np.array([key_ids.setdefault(key, len(key_ids)) for key, _ in gt_object],
+                          dtype='int64')
+    gt_xy = np.array([coord[0] for _, coord in gt_object], dtype='float64').reshape(-1, 2)
+    pred_key_ids = np.array([key_ids.get(text, -1) for text, _ in predict], dtype='int64')
+    pred_xy = np.array([box[0] for _, box in predict], dtype='float64').reshape(-1, 2)
 
-    correct_answer = 0
-    for i in gt_object:  # итерация по ключам из хмл
-        key = list(i)[0]
-        true_coord = i[key]
-        first_true = true_coord[0]
-        second_true = true_coord[1]
-        for i in range(len(predict)):
-            if predict[i][0] == key:
-                predict_coord = predict[i][1]
-                first_predict = predict_coord[0]
-                second_predict = predict_coord[2]
-                if compare_difference(first_predict[0], first_true[0]) == True \
-                        and compare_difference(first_predict[1], first_true[1]) == True:
-                    correct_answer += 1
+    correct_answer = _count_correct(gt_xy, gt_key_ids, pred_xy, pred_key_ids, 10)
 
     return round((correct_answer / len(gt_object)), 2)
 
@@ -1077,29 +1299,88 @@ def count_precision(xml_file, predict_file):
            precision(other, predict_file)
 
 
-def quality_df(images_paths, xmls_paths, pipeline, resize=True):
+_REDUCED_READ_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                       (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def _read_reduced(img, min_width, min_height):
+    # decode a downscaled image (DCT scaling for jpeg) if it stays larger than
+    # the requested size; cv2.imread applies the EXIF orientation, so the sides
+    # are swapped here for the orientations that rotate by 90 degrees
+    with Image.open(img) as image:
+        width, height = image.size
+        if image.getexif().get(_EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            width, height = height, width
+    for factor, flag in _REDUCED_READ_FLAGS:
+        if width // factor >= min_width and height // factor >= min_height:
+            return cv2.cvtColor(cv2.imread(img, flag), cv2.COLOR_BGR2RGB)
+    return read(img)
+
+
+def _load_quality_image(img, resize, resize_in_graph):
+    if not resize:
+        return read(img)
+    inp = _read_reduced(img, 500, 1080)
+    if not resize_in_graph:
+        inp = cv2.resize(inp, (500, 1080))
+    return inp
+
+
+def _prefetch(func, items, max_workers):
+    # yields func(item) in order, loading up to max_workers items ahead in threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending: typing.Deque[concurrent.futures.Future] = collections.deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) > max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _same_shape_batches(pairs, batch_size):
+    # consecutive (image, xml) pairs, split into batches of images of the same shape
+    batch: typing.List[typing.Tuple[np.ndarray, str]] = []
+    for image, xml in pairs:
+        if batch and (len(batch) == batch_size or batch[0][0].shape != image.shape):
+            yield batch
+            batch = []
+        batch.append((image, xml))
+    if batch:
+        yield batch
+
+
+def quality_df(images_paths, xmls_paths, pipeline, resize=True, prefetch=4, batch_size=8):
+    import tqdm.notebook
     quality_results = {
         'image_name': [],
         'card_acc': [],
         'money_acc': [],
         'other_acc': [],
     }
+    # a model created with input_size=(1080, 500) resizes on device, then the
+    # images are only decoded at a reduced size here
+    resize_in_graph = getattr(pipeline, 'input_size', None) == (1080, 500)
     images_paths.sort()
     xmls_paths.sort()
-    for xml, img in tqdm.notebook.tqdm(zip(xmls_paths, images_paths)):
-        #inp = cv2.imread(img)
-        inp = read(img)
-        if resize:
-            inp = cv2.resize(inp, (500, 1080))
-        inp = np.expand_dims(inp, 0)
-        predict_list = pipeline.recognize(inp)[0]
-        try:
-            res = count_precision(xml, predict_list)
-            quality_results['image_name'].append(os.path.basename(xml))
-            quality_results['card_acc'].append(res[0])
-            quality_results['money_acc'].append(res[1])
-            quality_results['other_acc'].append(res[2])
-        except Exception as e:
-            print('empty xml', e)
+    # images are read while the model is busy with the previous batch
+    inputs = _prefetch(
+        functools.partial(_load_quality_image, resize=resize, resize_in_graph=resize_in_graph),
+        images_paths[:len(xmls_paths)], prefetch)
+    pairs = tqdm.notebook.tqdm(zip(inputs, xmls_paths))
+    # keras_ocr.pipeline.Pipeline has no recognize_batch
+    recognize_batch = getattr(pipeline, 'recognize_batch',
+                              lambda images: pipeline.recognize(np.stack(images)))
+    for batch in _same_shape_batches(pairs, batch_size):
+        images, xmls = zip(*batch)
+        for xml, predict_list in zip(xmls, recognize_batch(images)):
+            try:
+                res = count_precision(xml, predict_list)
+                quality_results['image_name'].append(os.path.basename(xml))
+                quality_results['card_acc'].append(res[0])
+                quality_results['money_acc'].append(res[1])
+                quality_results['other_acc'].append(res[2])
+            except Exception as e:
+                print('empty xml', e)
     res_df = pd.DataFrame(quality_results)
-    return res_df
\ No newline at end of file
+    return res_df
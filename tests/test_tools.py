@@ -1,4 +1,9 @@
+import cv2
+import imgaug
 import numpy as np
+import pytest
+import tensorflow as tf
+from PIL import Image
 from keras_ocr import tools
 
 
@@ -22,3 +27,321 @@ def test_fix_line():
     assert vertical_line_fixed[1] == 'vertical'
     assert ''.join([character for _, character in vertical_line_fixed[0]]) == 'abcd'
     assert ''.join([character for _, character in horizontal_line_fixed[0]]) == 'abcd'
+
+
+def _gradient_image(height=60, width=80):
+    y, x = np.mgrid[:height, :width]
+    return np.stack([x * 3, y * 4, (x + y) * 2], axis=-1).astype('uint8')
+
+
+def test_warp_box_axis_aligned():
+    image = _gradient_image()
+    box = np.array([[10, 5], [50, 5], [50, 25], [10, 25]])
+    warped = tools.warpBox(image, box, target_height=20, target_width=40)
+    assert warped.shape == (20, 40, 3)
+    np.testing.assert_array_equal(warped, image[5:25, 10:50])
+
+
+def test_warp_box_straightens_rotated_box():
+    image = _gradient_image()
+    rotated = np.rot90(image).copy()
+    width = image.shape[1]
+    # the box above, rotated along with the image; still listed clockwise
+    # from the top left corner of the text
+    box = np.array([[5, width - 11], [5, width - 51], [25, width - 51], [25, width - 11]])
+    warped = tools.warpBox(rotated, box, target_height=20, target_width=40)
+    np.testing.assert_array_equal(warped, image[5:25, 10:50])
+
+
+def test_warp_box_cval():
+    image = _gradient_image()
+    box = np.array([[10, 5], [50, 5], [50, 25], [10, 25]])
+    # scaled by 2 to fill the height, leaving the right of the target empty
+    warped = tools.warpBox(image, box, target_height=40, target_width=100, cval=128)
+    assert (warped[:, 80:] == 128).all()
+    warped = tools.warpBox(image, box, target_height=40, target_width=100, cval=(1, 2, 3))
+    assert (warped[:, 80:] == [1, 2, 3]).all()
+    # scaled by 1 to fill the width, leaving the bottom of the target empty
+    warped = tools.warpBox(image, box, target_height=30, target_width=40, cval=(1, 2, 3))
+    np.testing.assert_array_equal(warped[:20], image[5:25, 10:50])
+    assert (warped[20:] == [1, 2, 3]).all()
+
+
+def test_warp_box_grayscale():
+    image = _gradient_image()[..., 0]
+    box = np.array([[10, 5], [50, 5], [50, 25], [10, 25]])
+    warped = tools.warpBox(image, box, target_height=30, target_width=40, cval=7)
+    assert warped.shape == (30, 40)
+    np.testing.assert_array_equal(warped[:20], image[5:25, 10:50])
+    assert (warped[20:] == 7).all()
+
+
+def test_warp_box_batch():
+    image = _gradient_image()
+    boxes = np.array([[[10, 5], [50, 5], [50, 25], [10, 25]], [[0, 0], [20, 0], [20, 10], [0, 10]]])
+    warped = tools.warpBox_batch(image, boxes, target_height=31, target_width=200)
+    assert warped.shape == (2, 31, 200, 3)
+    for box, crop in zip(boxes, warped):
+        np.testing.assert_array_equal(crop,
+                                      tools.warpBox(image, box, target_height=31, target_width=200))
+    empty = tools.warpBox_batch(image, np.zeros((0, 4, 2)), target_height=31, target_width=200)
+    assert empty.shape == (0, 31, 200, 3)
+
+
+def _augment_reference(boxes, augmenter, image_shape, augmented_shape, area_threshold=0.5):
+    # one keypoint call and one area check per box
+    kept = []
+    for box in boxes:
+        box = augmenter.augment_keypoints(
+            imgaug.KeypointsOnImage.from_xy_array(box, shape=image_shape)).to_xy_array()
+        clipped = box.copy()
+        clipped[:, 0] = clipped[:, 0].clip(0, augmented_shape[1])
+        clipped[:, 1] = clipped[:, 1].clip(0, augmented_shape[0])
+        area_before = cv2.contourArea(np.int32(box)[:, np.newaxis, :])
+        area_after = cv2.contourArea(np.int32(clipped)[:, np.newaxis, :])
+        kept.append(clipped if area_before > 0 and area_after >= area_threshold *
+                    area_before else None)
+    return kept
+
+
+def test_augment_matches_per_box_reference():
+    image = _gradient_image(120, 160)
+    rng = np.random.RandomState(42)
+    corners = rng.uniform([0, 0], [140, 100], size=(20, 1, 2))
+    sizes = rng.uniform([5, 5], [60, 30], size=(20, 1, 2))
+    boxes = corners + np.array([[0, 0], [1, 0], [1, 1], [0, 1]]) * sizes
+    lines = [[(box, 'abcd'[index % 4]) for index, box in enumerate(boxes[start:start + 5])]
+             for start in range(0, 20, 5)]
+    predictions = [('word%d' % index, box) for index, box in enumerate(boxes)]
+    for seed in range(5):
+        augmenter = imgaug.augmenters.Sequential([
+            imgaug.augmenters.Affine(rotate=(-30, 30), scale=(0.8, 1.2)),
+            imgaug.augmenters.Fliplr(0.5),
+            imgaug.augmenters.CropAndPad(px=(-40, 20), keep_size=False),
+        ],
+                                                 random_state=seed).to_deterministic()
+        image_augmented, boxes_augmented = tools.augment(boxes=boxes,
+                                                         augmenter=augmenter,
+                                                         image=image)
+        expected = _augment_reference(boxes, augmenter, image.shape[:2], image_augmented.shape[:2])
+        np.testing.assert_allclose(boxes_augmented, [box for box in expected if box is not None],
+                                   atol=1e-4)
+
+        # Without an image, the augmented shape is given by the augmented
+        # bottom right corner.
+        image_none, boxes_shape_only = tools.augment(boxes=boxes,
+                                                     augmenter=augmenter,
+                                                     image_shape=image.shape[:2])
+        assert image_none is None
+        width, height = augmenter.augment_keypoints(
+            imgaug.KeypointsOnImage.from_xy_array([[image.shape[1], image.shape[0]]],
+                                                  shape=image.shape[:2])).to_xy_array()[0]
+        expected_shape_only = _augment_reference(boxes, augmenter, image.shape[:2], (height, width))
+        np.testing.assert_allclose(boxes_shape_only,
+                                   [box for box in expected_shape_only if box is not None],
+                                   atol=1e-4)
+
+        _, lines_augmented = tools.augment(boxes=lines,
+                                           augmenter=augmenter,
+                                           image=image,
+                                           boxes_format='lines')
+        expected_lines = [[(box, character)
+                           for (_, character), box in zip(line, expected[start:start + 5])
+                           if box is not None] for line, start in zip(lines, range(0, 20, 5))]
+        expected_lines = [line for line in expected_lines if line]
+        assert [[character for _, character in line] for line in lines_augmented
+                ] == [[character for _, character in line] for line in expected_lines]
+        for line, expected_line in zip(lines_augmented, expected_lines):
+            np.testing.assert_allclose([box for box, _ in line], [box for box, _ in expected_line],
+                                       atol=1e-4)
+
+        _, predictions_augmented = tools.augment(boxes=predictions,
+                                                 augmenter=augmenter,
+                                                 image=image,
+                                                 boxes_format='predictions')
+        expected_predictions = [(word, box) for (word, _), box in zip(predictions, expected)
+                                if box is not None]
+        assert [word
+                for word, _ in predictions_augmented] == [word for word, _ in expected_predictions]
+        np.testing.assert_allclose([box for _, box in predictions_augmented],
+                                   [box for _, box in expected_predictions],
+                                   atol=1e-4)
+
+
+def test_get_rotated_box():
+    box, rotation = tools.get_rotated_box([[10, 20], [30, 20], [30, 25], [10, 25], [20, 22]])
+    np.testing.assert_allclose(box, [[10, 20], [30, 20], [30, 25], [10, 25]])
+    assert rotation == 0
+    # Too few points for a rotated rectangle.
+    for points in ([[10, 20]], [[10, 20], [30, 25]]):
+        with pytest.raises(ValueError):
+            tools.get_rotated_box(points)
+
+
+def _order_points_args(rng):
+    return (rng.uniform(0, 100, size=(4, 2)), )
+
+
+def _count_correct_args(rng):
+    gt_xy = rng.randint(0, 50, size=(6, 2)).astype('float64')
+    pred_xy = rng.randint(0, 50, size=(8, 2)).astype('float64')
+    return gt_xy, rng.randint(0, 3, size=6), pred_xy, rng.randint(-1, 3, size=8), 10
+
+
+@pytest.mark.parametrize('func,make_args', [(tools._order_points, _order_points_args),
+                                            (tools._count_correct, _count_correct_args)])
+def test_jitted_matches_python(func, make_args):
+    # without numba both are plain python and the comparison is trivial
+    python_func = getattr(func, 'py_func', func)
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        args = make_args(rng)
+        actual, expected = func(*args), python_func(*args)
+        if not isinstance(expected, tuple):
+            actual, expected = (actual, ), (expected, )
+        for actual_part, expected_part in zip(actual, expected):
+            np.testing.assert_allclose(actual_part, expected_part)
+
+
+def test_bbox_layer():
+    heatmap = np.zeros((2, 32, 32, 2), dtype='float32')
+    heatmap[0, 5:10, 10:20, 0] = 1  # text region
+    heatmap[0, 0:3, 0:2, 0] = 1  # touches row 0 and column 0
+    heatmap[0, 0:3, 2:4, 1] = 1  # joined to it by the link map
+    heatmap[1, 20:25, 4:30, 0] = 1
+    xyhw = tools.BboxLayer()(tf.constant(heatmap)).numpy()
+    # one layer per component id plus an empty last layer, in y, x, h, w
+    # order; the masks are dilated by 2 pixels on every side
+    assert xyhw.shape == (2, 3, 4)
+    assert sorted(map(tuple, xyhw[0])) == [(0, 0, 1, 1), (0, 0, 4, 5), (3, 8, 8, 13)]
+    assert sorted(map(tuple, xyhw[1])) == [(0, 0, 1, 1), (0, 0, 1, 1), (18, 2, 8, 29)]
+
+
+def test_crop_bboxes_layer():
+    image = np.tile(np.linspace(0.2, 0.8, 160, dtype="float32"), (64, 1))[np.newaxis, ...,
+                                                                          np.newaxis]
+    # y, x, h, w at half resolution
+    bboxes = np.array([[[5, 10, 5, 20], [5, 10, 2, 50], [0, 0, 3, 20]]], dtype='int32')
+    crops = tools.CropBboxesLayer()([tf.constant(image), tf.constant(bboxes)]).numpy()
+    assert crops.shape == (1, 3, 31, 200, 1)
+    assert crops.dtype == np.uint8
+    crops = crops[0, ..., 0]
+
+    # Each crop is scaled to fit and placed in the bottom left corner,
+    # the rest is zero.
+    # 20x40 box scaled by 3.1: 31 rows, 124 columns
+    assert (crops[0, :, :124] > 0).all() and (crops[0, :, 124:] == 0).all()
+    # 8x200 box scaled by 2: 8 rows, 200 columns
+    assert (crops[1, :23] == 0).all() and (crops[1, 23:] > 0).all()
+    # 12x80 box at the image corner scaled by 2.5: 30 rows, 200 columns
+    assert (crops[2, :1] == 0).all() and (crops[2, 1:] > 0).all()
+
+    # The content is not flipped and follows the source image.
+    expected = np.round(image[0, 10, 20:60, 0] * 255)
+    np.testing.assert_allclose(crops[0, 0, [0, 123]], expected[[0, -1]], atol=1)
+    np.testing.assert_allclose(crops[2, 1:, 0], np.round(0.2 * 255), atol=1)
+    assert (np.diff(crops[1, 23:].astype(int), axis=1) >= 0).all()
+
+
+def _labelme_object(name, value, x, y):
+    points = ''.join(f'<pt><x>{x + dx}</x><y>{y + dy}</y></pt>'
+                     for dx, dy in [(0, 0), (30, 0), (30, 10), (0, 10)])
+    return (f'<object><name>{name}</name><deleted>0</deleted>'
+            f'<polygon><username>a</username>{points}</polygon>'
+            f'<attributes>text={value}</attributes></object>')
+
+
+def test_quality_check_utils(tmp_path):
+    xml_file = tmp_path / 'frame.xml'
+    xml_file.write_text('<annotation><filename>frame.jpg</filename>' + ''.join([
+        _labelme_object('cards', 'ah', 10.7, 20.2),
+        _labelme_object('cards', 'h', 50, 20),
+        _labelme_object('cards', 's', 90, 20),
+        _labelme_object('cards', 'kd', 130, 20),
+        _labelme_object('money', '50', 10, 100),
+        _labelme_object('other', 'bet', 10, 200),
+    ]) + '</annotation>')
+
+    cards = tools.objects_bb(str(xml_file), 'cards')
+    assert [key for key, _ in cards] == ['ah', 'h', 's', 'kd']
+    assert cards[0][1].dtype == np.int32
+    np.testing.assert_array_equal(cards[0][1], [[10, 20], [40, 20], [40, 30], [10, 30]])
+    assert tools.objects_bb(str(xml_file), 'missing') == []
+
+    # consecutive single suits are all dropped
+    cards, money, other = tools.got_gt_objects(str(xml_file))
+    assert [key for key, _ in cards] == ['ah', 'kd']
+    assert [key for key, _ in money] == ['50']
+    assert [key for key, _ in other] == ['bet']
+
+    box = np.array([[0, 0], [30, 0], [30, 10], [0, 10]], dtype='float32')
+    predict = [
+        ('ah', box + [18, 27]),  # within 10 pixels of the top left corner
+        ('kd', box + [145, 20]),  # too far
+        ('xx', box + [130, 20]),  # wrong text
+    ]
+    assert tools.precision(cards, predict) == 0.5
+    assert tools.precision(money, predict) == 0
+    assert tools.precision(cards, []) == 0
+
+
+@pytest.mark.parametrize('size,orientation,expected_shape', [
+    ((2560, 1440), 1, (1440, 2560, 3)),  # landscape, halving would leave 720 rows
+    ((1440, 2560), 1, (1280, 720, 3)),
+    ((2560, 1440), 6, (1280, 720, 3)),  # landscape on disk, portrait after EXIF rotation
+])
+def test_read_reduced(tmp_path, size, orientation, expected_shape):
+    filepath = str(tmp_path / 'frame.jpg')
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    Image.new('RGB', size, (200, 100, 50)).save(filepath, exif=exif)
+    assert tools._read_reduced(filepath, 500, 1080).shape == expected_shape
+
+
+class _RecognizeOnlyPipeline:
+    # like keras_ocr.pipeline.Pipeline, no recognize_batch
+    def __init__(self, predict):
+        self.predict = predict
+        self.batch_sizes = []
+
+    def recognize(self, images):
+        self.batch_sizes.append(len(images))
+        return [self.predict] * len(images)
+
+
+def test_quality_df_with_recognize_only(tmp_path):
+    images_paths, xmls_paths = [], []
+    for index in range(3):
+        image_path = tmp_path / f'frame{index}.png'
+        Image.new('RGB', (200, 120)).save(image_path)
+        xml_path = tmp_path / f'frame{index}.xml'
+        xml_path.write_text('<annotation>' + ''.join([
+            _labelme_object('cards', 'ah', 10, 20),
+            _labelme_object('money', '50', 10, 100),
+            _labelme_object('other', 'bet', 10, 200),
+        ]) + '</annotation>')
+        images_paths.append(str(image_path))
+        xmls_paths.append(str(xml_path))
+    box = np.array([[0, 0], [30, 0], [30, 10], [0, 10]], dtype='float32')
+    pipeline = _RecognizeOnlyPipeline([('ah', box + [10, 20]), ('10', box + [10, 100])])
+    df = tools.quality_df(images_paths, xmls_paths, pipeline, resize=False, batch_size=2)
+    assert pipeline.batch_sizes == [2, 1]
+    assert list(df['image_name']) == ['frame0.xml', 'frame1.xml', 'frame2.xml']
+    assert list(df['card_acc']) == [1.0, 1.0, 1.0]
+    assert list(df['money_acc']) == [0.0, 0.0, 0.0]
+
+
+def test_one_graph_pipeline_recognize_in_batches():
+    # stand-in for the one graph model: the label of every image is its fill value
+    inp = tf.keras.Input([None, None, 3], dtype='uint8')
+    labels = tf.keras.layers.Lambda(lambda x: tf.cast(x[:, :1, 0, :1], 'int64'))(inp)
+    bboxes = tf.keras.layers.Lambda(lambda x: tf.zeros([tf.shape(x)[0], 1, 4, 2]))(inp)
+    pipeline = tools.OneGraphPipeline(tf.keras.models.Model(inputs=inp, outputs=[[labels], bboxes]),
+                                      alphabet='abcde')
+    images = np.arange(5, dtype='uint8')[:, np.newaxis, np.newaxis, np.newaxis] * np.ones(
+        (1, 8, 8, 3), dtype='uint8')
+    for batch_size in [2, 32]:
+        prediction_groups = pipeline.recognize(images, batch_size=batch_size)
+        assert [[text for text, _ in group] for group in prediction_groups] == [
+            ['a'], ['b'], ['c'], ['d'], ['e']
+        ]